@@ -1,4 +1,4 @@
-from flask import Flask, abort, request, jsonify, g, url_for, redirect
+from flask import Flask, abort, request, jsonify, g, url_for, redirect, has_request_context, make_response
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_httpauth import HTTPBasicAuth
@@ -6,6 +6,9 @@ from passlib.apps import custom_app_context as pwd_context
 
 from itsdangerous import (TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired)
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 import os
 import sys
 import traceback
@@ -13,6 +16,38 @@ import threading
 import json
 import datetime
 import time
+import shutil
+import sqlite3
+import signal
+import hashlib
+import math
+import functools
+
+# database location, shared by the app and the management plane
+DATABASE_PATH = os.environ.get('QND_DATABASE', '/database/db.sqlite')
+DATABASE_URI = 'sqlite:///' + DATABASE_PATH
+SNAPSHOT_PATH = os.environ.get('QND_SNAPSHOT', DATABASE_PATH + '.snapshot')
+SNAPSHOT_INTERVAL = int(os.environ.get('QND_SNAPSHOT_INTERVAL', '300'))
+# exists while the apps run, left behind after a crash
+RUNNING_PATH = DATABASE_PATH + '.running'
+# FULL syncs every commit; NORMAL is faster but can lose the last commits on power loss
+SYNCHRONOUS = os.environ.get('QND_SYNCHRONOUS', 'FULL').upper()
+
+# per user/queue limits: messages per second, burst size and max messages waiting in a queue
+PUBLISH_RATE = float(os.environ.get('QND_PUBLISH_RATE', '50'))
+PUBLISH_BURST = float(os.environ.get('QND_PUBLISH_BURST', '100'))
+CONSUME_RATE = float(os.environ.get('QND_CONSUME_RATE', '10'))
+CONSUME_BURST = float(os.environ.get('QND_CONSUME_BURST', '20'))
+MAX_QUEUE_DEPTH = int(os.environ.get('QND_MAX_QUEUE_DEPTH', '10000'))
+
+# message bodies larger than BLOB_THRESHOLD bytes are kept in BLOB_PATH instead of the messages table
+BLOB_PATH = os.environ.get('QND_BLOBS', os.path.join(os.path.dirname(DATABASE_PATH), 'blobs'))
+BLOB_THRESHOLD = int(os.environ.get('QND_BLOB_THRESHOLD', '65536'))
+
+# opt-in request tracing: slow request log threshold and repeats of one statement before it is reported as N+1
+TRACE = os.environ.get('QND_TRACE', '') == '1'
+SLOW_REQUEST_MS = float(os.environ.get('QND_SLOW_REQUEST_MS', '500'))
+N_PLUS_ONE = int(os.environ.get('QND_N_PLUS_ONE', '10'))
 
 # initialization
 app = Flask(__name__)
@@ -20,8 +55,19 @@ management = Flask(__name__)
 
 # extensions: db + auth
 db = SQLAlchemy(app)
+db.init_app(management)
 auth = HTTPBasicAuth()
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Put every connection in WAL mode, so snapshots and readers don't block writers
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=%s' % ('NORMAL' if SYNCHRONOUS == 'NORMAL' else 'FULL'))
+    cursor.close()
+
 class User(db.Model):
     """
     Basic user model
@@ -63,8 +109,269 @@ class Message(db.Model):
     queue = db.Column(db.String(32), index=True)
     username = db.Column(db.String(32))
     message = db.Column(db.String)
+    blob = db.Column(db.String(64), index=True)
     created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+    def content(self):
+        """
+        Message body, None when its blob can't be read
+        """
+        if self.blob is None:
+            return self.message
+        try:
+            return load_blob(self.blob)
+        except (IOError, OSError, UnicodeDecodeError):
+            print('!! message %s: blob %s unreadable' % (self.id, self.blob))
+            return None
+
+
+class RateLimiter:
+    """
+    Token bucket per key, kept in memory. Full buckets are dropped, a missing bucket counts as full.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.swept = time.time()
+        self.lock = threading.Lock()
+
+    def _sweep(self, now):
+        # call with the lock held; a bucket untouched for burst / rate seconds is full again
+        self.buckets = dict((key, (tokens, last)) for key, (tokens, last) in self.buckets.items()
+                            if tokens + (now - last) * self.rate < self.burst)
+        self.swept = now
+
+    def take(self, key):
+        """
+        Take a token for key. Returns 0 when allowed, else the seconds until a token is available
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.swept >= self.burst / self.rate:
+                self._sweep(now)
+
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+
+class QueueDepth:
+    """
+    Number of messages per queue, seeded from the database on startup.
+    Posts reserve a slot in memory, anything else that changes a queue recounts it.
+    """
+
+    def __init__(self):
+        self.depths = {}
+        self.seeded = False
+        self.lock = threading.Lock()
+
+    def _depth(self, queue):
+        # call with the lock held; once seeded, a queue we don't know is empty
+        if queue not in self.depths:
+            self.depths[queue] = 0 if self.seeded else Message.query.filter_by(queue=queue).count()
+        return self.depths[queue]
+
+    def get(self, queue):
+        with self.lock:
+            return self._depth(queue)
+
+    def reserve(self, queue, limit):
+        """
+        Take a slot for a new message. Returns the new depth, or None when the queue is full
+        """
+        with self.lock:
+            depth = self._depth(queue)
+            if depth >= limit:
+                return None
+            self.depths[queue] = depth + 1
+            return depth + 1
+
+    def seed(self, depths):
+        with self.lock:
+            self.depths = dict(depths)
+            self.seeded = True
+
+    def recount(self, queue):
+        """
+        Count the queue again after messages are added or deleted, cheap with the queue index
+        """
+        with self.lock:
+            self.depths[queue] = Message.query.filter_by(queue=queue).count()
+
+
+publish_limiter = RateLimiter(PUBLISH_RATE, PUBLISH_BURST)
+consume_limiter = RateLimiter(CONSUME_RATE, CONSUME_BURST)
+endpoint_limiters = {'post_msg': publish_limiter, 'get_msg': consume_limiter}
+queue_depth = QueueDepth()
+
+def rate_limited(wait):
+    """
+    429 response telling the client when to come back
+    """
+    retry = int(wait) + 1
+    return make_response(jsonify({'error': 'rate limited', 'retry_after': retry}), 429, {'Retry-After': str(retry)})
+
+def rate_limit(username_or_token):
+    """
+    Take a token for the caller before the (slow) password check, aborts with 429 when over the limit.
+    Token callers are known by their user id, password callers by username and address.
+    Every user has one queue, so the unchecked queue in the path isn't part of the key.
+    """
+    limiter = endpoint_limiters.get(request.endpoint)
+    if limiter is None:
+        return
+
+    try:
+        caller = Serializer(app.config['SECRET_KEY']).loads(username_or_token)['id']
+    except BadSignature:
+        caller = (username_or_token, request.remote_addr)
+
+    wait = limiter.take(caller)
+    if wait:
+        abort(rate_limited(wait))
+
+
+def to_json(*args, **kwargs):
+    """
+    jsonify, timed as the serialize span
+    """
+    start = time.time()
+    response = jsonify(*args, **kwargs)
+    trace_span('serialize', start)
+    return response
+
+
+# held while a blob can gain or lose its last reference
+blob_lock = threading.Lock()
+# blobs the last snapshot refers to, kept until the next snapshot replaces it
+snapshot_blobs = set()
+# while a snapshot copies, released blobs wait here instead of being removed
+snapshot_running = threading.Event()
+snapshot_pending = set()
+
+def blob_file(digest):
+    return os.path.join(BLOB_PATH, digest[:2], digest)
+
+def store_blob(raw):
+    """
+    Write raw bytes to the blob store, named by their sha256. Identical bodies are stored once.
+    """
+    digest = hashlib.sha256(raw).hexdigest()
+    path = blob_file(digest)
+    if os.path.exists(path):
+        return digest
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    return digest
+
+def load_blob(digest):
+    """
+    Read a blob, it goes into the JSON response as a whole
+    """
+    with open(blob_file(digest), 'rb') as f:
+        return f.read().decode('utf-8')
+
+def release_blob(digest):
+    """
+    Remove a blob once no message refers to it anymore
+    """
+    if digest is None:
+        return
+    with blob_lock:
+        if snapshot_running.is_set():
+            snapshot_pending.add(digest)
+            return    # the running snapshot may still refer to it
+        if digest in snapshot_blobs:
+            return    # collect_blobs removes it after the next snapshot
+        if Message.query.filter_by(blob=digest).count() == 0:
+            try:
+                os.remove(blob_file(digest))
+            except OSError:
+                pass
+
+def blobs_in(path):
+    """
+    Blobs referred to by the database file at path
+    """
+    if not os.path.exists(path):
+        return set()
+    conn = sqlite3.connect(path)
+    try:
+        return set(row[0] for row in conn.execute('SELECT DISTINCT blob FROM messages WHERE blob IS NOT NULL'))
+    except sqlite3.OperationalError:
+        return set()    # older than the blob column
+    finally:
+        conn.close()
+
+def collect_blobs():
+    """
+    Remove blobs that neither the database nor the last snapshot refer to, e.g. written just before a crash
+    """
+    if not os.path.isdir(BLOB_PATH):
+        return
+    used = blobs_in(DATABASE_PATH)
+    candidates = []
+    for folder in os.listdir(BLOB_PATH):
+        for name in os.listdir(os.path.join(BLOB_PATH, folder)):
+            if name not in used:
+                candidates.append(name)
+    remove_unused_blobs(candidates)
+
+def remove_unused_blobs(digests):
+    """
+    Remove the blobs no message or snapshot refers to, checked one by one under the lock
+    """
+    if not digests:
+        return
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        for digest in digests:
+            with blob_lock:
+                if snapshot_running.is_set() or digest in snapshot_blobs:
+                    continue
+                if conn.execute('SELECT 1 FROM messages WHERE blob = ? LIMIT 1', (digest,)).fetchone() is None:
+                    try:
+                        os.remove(blob_file(digest))
+                    except OSError:
+                        pass
+    finally:
+        conn.close()
+
+def add_message(queue, username, data):
+    """
+    Store a message, large bodies go to the blob store
+    """
+    raw = data if isinstance(data, bytes) else data.encode('utf-8')
+    if len(raw) <= BLOB_THRESHOLD:
+        message = Message(queue=queue, username=username, message=data)
+        db.session.add(message)
+        db.session.commit()
+        return message
+
+    # reject what the inline path can't store either, before it reaches the blob store
+    raw.decode('utf-8')
+
+    with blob_lock:
+        message = Message(queue=queue, username=username, blob=store_blob(raw))
+        db.session.add(message)
+        db.session.commit()
+    return message
+
 
 class Style:
     """
@@ -229,14 +536,20 @@ def verify_password(username_or_token, password):
     Verify user password
     """
 
+    start = time.time()
+
+    rate_limit(username_or_token)
+
     # first try to authenticate by token
     user = User.verify_auth_token(username_or_token)
     if not user:
         # try to authenticate with username/password
         user = User.query.filter_by(username=username_or_token).first()
         if not user or not user.verify_password(password):
+            trace_span('auth', start)
             return False
     g.user = user
+    trace_span('auth', start)
     return True
 
 
@@ -248,22 +561,25 @@ def get_view():
     """
     try:
         queue = request.args.get('queue')
-        messages = Message.query.filter_by(queue=queue)
+        messages = Message.query.filter_by(queue=queue).all()
+        bodies = [message.content() or '' for message in messages]
 
+        start = time.time()
         content = Style.STYLE_MQS_BACK_BUTTON
         content = content + Style.STYLE_MQS_INPUTBOX.replace('$QUEUE$', queue)
         content = content + Style.STYLE_MQS_START.replace('$QUEUE$', queue)
 
-        for message in messages:
+        for message, body in zip(messages, bodies):
             date = None
             try:
                 date = unicode(message.created).split('.')[0]
             except:
                 date = ''
-            content = content + Style.STYLE_MQS_ROW.replace('$ID$', str(message.id)).replace('$MSG$', message.message).replace('$DATE$', date).replace('$QUEUE$', queue)
+            content = content + Style.STYLE_MQS_ROW.replace('$ID$', str(message.id)).replace('$MSG$', body).replace('$DATE$', date).replace('$QUEUE$', queue)
 
         content = content + Style.STYLE_MQS_END
         page = Style.BASIC_PAGE.replace('$TITLE$', 'Queue ' + queue).replace('$BODY$', content)
+        trace_span('serialize', start)
 
         return page
     except:
@@ -359,9 +675,8 @@ def get_post():
         if user is None:
             return page
 
-        message = Message(queue=queue, username=user.username, message=content)
-        db.session.add(message)
-        db.session.commit()
+        add_message(queue, user.username, content)
+        queue_depth.recount(queue)
         return page
 
     if action == 'delete_msg':
@@ -370,6 +685,8 @@ def get_post():
 
         db.session.delete(message)
         db.session.commit()
+        queue_depth.recount(message.queue)
+        release_blob(message.blob)
 
         queue = request.args["queue"]
         page = Style.BASIC_RETURN.replace('$URL$', '/view?queue=' + queue)
@@ -390,6 +707,13 @@ def get_index():
     # get all users
     users = User.query.all()
 
+    # count the messages per mq user
+    counts = {}
+    for user in users:
+        if user.queue != None and user.queue != '':
+            counts[user.id] = Message.query.filter_by(queue=user.queue).count()
+
+    start = time.time()
     adminusers = Style.STYLE_ADMIN_HEADER
     messagequeues = Style.STYLE_MESSAGES_HEADER
 
@@ -400,7 +724,7 @@ def get_index():
             adminusers = adminusers + '<tr><td>' + str(user.id) + '</td><td>' + user.username + '</td><td><a onclick="edit(\'' + user.username + '\', \'admin\', \'\')"><img class="edit" /></a><a onclick="msgbox(\'Do you want to delete user: ' + user.username + '?\',\'/process?action=delete&username=' + user.username + '\')"><img class="delete" /></a></td></tr>'
         else:
             # mq user
-            messages = Message.query.filter_by(queue=user.queue).count()
+            messages = counts[user.id]
             messagequeues = messagequeues + '<tr><td>' + str(user.id) + '</td><td>' + user.username + '</td><td>' + user.queue + '</td><td>' + str(messages) + '</td><td><a onclick="edit(\'' + user.username + '\', \'\', \'' + user.queue + '\')"><img class="edit" /></a><a onclick="msgbox(\'Do you want to delete user: ' + user.username + '?\',\'/process?action=delete&username=' + user.username + '\')"><img class="delete" /></a><a href="/view?queue=' + user.queue + '"><img class="magnify" /></a></td></tr>'
     
     adminusers = adminusers + Style.STYLE_ADMIN_FOOTER
@@ -418,6 +742,7 @@ def get_index():
         content = '<h2>Administrators</h2>' + adminusers + '<h2>Queues</h2>' + messagequeues + adding
 
     page = Style.BASIC_PAGE.replace('$TITLE$', 'Monitor').replace('$BODY$', content)
+    trace_span('serialize', start)
 
     return page
 
@@ -440,10 +765,10 @@ def post_install():
             db.session.add(user)
             db.session.commit()
 
-            return (jsonify({'username': user.username}), 201,
+            return (to_json({'username': user.username}), 201,
                 {'Location': url_for('get_user', id=user.id, _external=True)})
         else:
-            return (jsonify({}), 400)
+            return (to_json({}), 400)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -469,10 +794,10 @@ def get_install():
             db.session.add(user)
             db.session.commit()
 
-            return (jsonify({'username': user.username}), 201,
+            return (to_json({'username': user.username}), 201,
                 {'Location': url_for('get_user', id=user.id, _external=True)})
         else:
-            return (jsonify({}), 400)
+            return (to_json({}), 400)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -489,7 +814,7 @@ def get_users():
         for user in users:
             results.append(user.username)
 
-        return jsonify({'usernames': results})
+        return to_json({'usernames': results})
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -515,7 +840,7 @@ def new_user():
         db.session.add(user)
         db.session.commit()
 
-        return (jsonify({'username': user.username}), 201,
+        return (to_json({'username': user.username}), 201,
                 {'Location': url_for('get_user', id=user.id, _external=True)})
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -531,7 +856,7 @@ def get_user(id):
         user = User.query.get(id)
         if not user:
             abort(400)
-        return jsonify({'username': user.username})
+        return to_json({'username': user.username})
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -540,14 +865,14 @@ def get_user(id):
 
 @app.route('/api/version')
 def get_version():
-    return jsonify({'version': 'beta-1'})
+    return to_json({'version': 'beta-1'})
 
 @app.route('/api/token')
 @auth.login_required
 def get_auth_token():
     try:
         token = g.user.generate_auth_token(600)
-        return jsonify({'token': token.decode('ascii'), 'duration': 600})
+        return to_json({'token': token.decode('ascii'), 'duration': 600})
     except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -568,11 +893,19 @@ def post_msg(queue):
         else:
             data = json.dumps(data)
 
-        message = Message(queue=queue, username=g.user.username, message=data)
-        db.session.add(message)
-        db.session.commit()
+        # backpressure: consumers are falling behind
+        depth = queue_depth.reserve(queue, MAX_QUEUE_DEPTH)
+        if depth is None:
+            return (to_json({'error': 'queue full', 'depth': queue_depth.get(queue), 'max_depth': MAX_QUEUE_DEPTH}), 429, {'Retry-After': '1'})
+
+        try:
+            message = add_message(queue, g.user.username, data)
+        except:
+            db.session.rollback()
+            queue_depth.recount(queue)    # give the slot back
+            raise
 
-        return (jsonify({'id': message.id}), 201)
+        return (to_json({'id': message.id}), 201, {'X-Queue-Depth': str(depth)})
     except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -587,13 +920,23 @@ def get_msg(queue):
         if User.query.filter_by(username=g.user.username, queue=queue).first() is None:
             abort(400)    # not authorized
 
-        messages = Message.query.filter_by(queue=queue)
+        messages = Message.query.filter_by(queue=queue).all()
 
-        result = []
+        items = []
         for message in messages:
-            result.append(json.dumps({'id': message.id, 'queue': message.queue, 'username': message.username, 'message': message.message}))
-    
-        return (jsonify(messages = result), 200)
+            body = message.content()
+            if body is None:
+                if Message.query.filter_by(id=message.id).count() == 0:
+                    continue    # deleted while we were reading
+                items.append({'id': message.id, 'queue': message.queue, 'username': message.username, 'message': None, 'error': 'message body missing'})
+                continue
+            items.append({'id': message.id, 'queue': message.queue, 'username': message.username, 'message': body})
+
+        start = time.time()
+        result = [json.dumps(item) for item in items]
+        response = jsonify(messages = result)
+        trace_span('serialize', start)
+        return (response, 200)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -609,12 +952,20 @@ def clear_msg(queue):
 
         messages = Message.query.filter_by(queue=queue)
 
-        result = []
-        for message in messages:
-            db.session.delete(message)
-            db.session.commit()
+        blobs = set()
+        try:
+            for message in messages:
+                blobs.add(message.blob)
+                db.session.delete(message)
+                db.session.commit()
+        finally:
+            db.session.rollback()    # nothing to undo unless a delete failed
+            queue_depth.recount(queue)
+
+        for blob in blobs:
+            release_blob(blob)
         
-        return (jsonify({}), 202)
+        return (to_json({}), 202)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -644,11 +995,19 @@ def truncate_msg(queue):
                 else:
                     deleteds.append(message)
 
-        for delete in deletes:
-            db.session.delete(delete)
-            db.session.commit()
+        blobs = set(delete.blob for delete in deletes)
+        try:
+            for delete in deletes:
+                db.session.delete(delete)
+                db.session.commit()
+        finally:
+            db.session.rollback()    # nothing to undo unless a delete failed
+            queue_depth.recount(queue)
+
+        for blob in blobs:
+            release_blob(blob)
         
-        return (jsonify({}), 202)
+        return (to_json({}), 202)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -669,62 +1028,440 @@ def delete_msg(id):
             abort(400)
     
         if message == None:
-            return (jsonify({}), 204)
+            return (to_json({}), 204)
 
         db.session.delete(message)
         db.session.commit()
+        queue_depth.recount(message.queue)
+        release_blob(message.blob)
 
-        return (jsonify({'id': message.id}), 202)
+        return (to_json({'id': message.id}), 202)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
         print(''.join('!! ' + line for line in lines))  # Log it or whatever here
         abort(503)
 
+snapshot_lock = threading.Lock()
+
+def fsync_path(path):
+    """
+    Flush a file (or directory entry) to disk
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return    # directories can't be opened on every platform
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def check_database(path, full=True):
+    """
+    Returns True when the SQLite file at path opens and passes a quick check.
+    Without full only the header and schema are read.
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            if not full:
+                conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+                return True
+            return conn.execute('PRAGMA quick_check').fetchone()[0] == 'ok'
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return False
+
+def snapshot_database(target=None):
+    """
+    Online snapshot of the database.
+    The copy is one read transaction, in WAL mode writers carry on while it runs.
+    The snapshot is checked and fsync'ed before it replaces the previous one.
+    Blobs the snapshot refers to are kept until the next snapshot.
+    """
+    target = target or SNAPSHOT_PATH
+    tmp = target + '.tmp'
+
+    with snapshot_lock:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        # blobs released during the copy are parked in snapshot_pending, not removed
+        with blob_lock:
+            snapshot_running.set()
+        blobs = set()
+        try:
+            source = sqlite3.connect(DATABASE_PATH)
+            try:
+                if hasattr(source, 'backup'):
+                    dest = sqlite3.connect(tmp)
+                    try:
+                        source.backup(dest)
+                    finally:
+                        dest.close()
+                else:
+                    # no backup API on python 2, needs sqlite >= 3.27
+                    source.execute('VACUUM INTO ?', (tmp,))
+            finally:
+                source.close()
+
+            blobs = blobs_in(tmp)
+        finally:
+            with blob_lock:
+                if target == SNAPSHOT_PATH:
+                    snapshot_blobs.update(blobs)
+                snapshot_running.clear()
+                pending = list(snapshot_pending)
+                snapshot_pending.clear()
+
+        remove_unused_blobs(pending)
+
+        if not check_database(tmp):
+            os.remove(tmp)
+            raise sqlite3.DatabaseError('snapshot failed integrity check')
+
+        fsync_path(tmp)
+        os.rename(tmp, target)
+        fsync_path(os.path.dirname(os.path.abspath(target)))
+
+        if target == SNAPSHOT_PATH:
+            # blobs only the previous snapshot needed can go now
+            with blob_lock:
+                snapshot_blobs.clear()
+                snapshot_blobs.update(blobs)
+            collect_blobs()
+
+    return target
+
+def restore_database(source=None):
+    """
+    Replace the database with a snapshot. Only run this while the apps are stopped.
+    """
+    source = source or SNAPSHOT_PATH
+    if not check_database(source):
+        raise sqlite3.DatabaseError('snapshot %s failed integrity check' % source)
+
+    tmp = DATABASE_PATH + '.restore'
+    shutil.copyfile(source, tmp)
+    fsync_path(tmp)
+
+    # the old WAL belongs to the old database, don't let sqlite replay it
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(DATABASE_PATH + suffix):
+            os.remove(DATABASE_PATH + suffix)
+
+    os.rename(tmp, DATABASE_PATH)
+    fsync_path(os.path.dirname(os.path.abspath(DATABASE_PATH)))
+
+def warm_database():
+    """
+    Read the indexes once and seed the queue depths from them.
+    Connections aren't pooled for SQLite files, so this warms the OS cache, not SQLite's own.
+    """
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        # both are answered from ix_messages_queue and ix_users_username, payloads aren't read
+        depths = dict(conn.execute('SELECT queue, COUNT(*) FROM messages GROUP BY queue').fetchall())
+        conn.execute('SELECT username FROM users').fetchall()
+    finally:
+        conn.close()
+
+    queue_depth.seed(depths)
+
+def migrate_database():
+    """
+    Add columns that are newer than the database
+    """
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'blob' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN blob VARCHAR(64)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_messages_blob ON messages (blob)')
+            conn.commit()
+    finally:
+        conn.close()
+
+def startup_database():
+    """
+    Validate the database on startup, fall back to the last snapshot if it is missing or damaged.
+    The full check only runs when the last run didn't stop cleanly.
+    """
+    if os.path.exists(DATABASE_PATH):
+        if not check_database(DATABASE_PATH, full=os.path.exists(RUNNING_PATH)):
+            if not os.path.exists(SNAPSHOT_PATH):
+                print('Database %s is damaged and there is no snapshot at %s, not starting' % (DATABASE_PATH, SNAPSHOT_PATH))
+                sys.exit(1)
+            print('Database failed integrity check, restoring snapshot...')
+            restore_database()
+    elif os.path.exists(SNAPSHOT_PATH):
+        print('Database missing, restoring snapshot...')
+        restore_database()
+
+    # create_all only adds missing tables
+    db.create_all()
+    migrate_database()
+    snapshot_blobs.update(blobs_in(SNAPSHOT_PATH))
+    collect_blobs()
+    warm_database()
+
+    open(RUNNING_PATH, 'w').close()
+
+@management.route('/api/snapshot', methods=['POST'])
+@auth.login_required
+def post_snapshot():
+    try:
+        target = snapshot_database()
+        return (to_json({'snapshot': target, 'size': os.path.getsize(target)}), 201)
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        print(''.join('!! ' + line for line in lines))  # Log it or whatever here
+        abort(503)
+
+# statement -> [count, seconds], filled while tracing
+query_stats = {}
+query_stats_lock = threading.Lock()
+
+def trace_span(name, start, detail=None):
+    """
+    Record a span on the trace of the current request, no-op when tracing is off
+    """
+    if not TRACE or not has_request_context():
+        return
+    trace = getattr(g, 'trace', None)
+    if trace is not None:
+        trace.append((name, start, time.time() - start, detail))
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    duration = time.time() - start
+
+    with query_stats_lock:
+        stats = query_stats.setdefault(statement, [0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+
+    trace_span('sql', start, statement)
+
+def handle_error(context):
+    # after_cursor_execute doesn't run for a failed statement
+    conn = context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+def start_trace():
+    g.trace = []
+    g.trace_start = time.time()
+
+def end_trace(response):
+    """
+    Add Server-Timing to the response, log slow requests and repeated statements
+    """
+    trace = getattr(g, 'trace', None)
+    if trace is None:
+        return response
+    if hasattr(g, 'trace_view_end'):
+        trace_span('response', g.trace_view_end)
+    total = time.time() - g.trace_start
+
+    durations = {}
+    statements = {}
+    for name, start, duration, detail in trace:
+        durations[name] = durations.get(name, 0.0) + duration
+        if name == 'sql':
+            statements[detail] = statements.get(detail, 0) + 1
+
+    timing = ['%s;dur=%.1f' % (name, duration * 1000) for name, duration in sorted(durations.items())]
+    timing.append('total;dur=%.1f' % (total * 1000))
+    response.headers['Server-Timing'] = ', '.join(timing)
+
+    for statement, count in statements.items():
+        if count >= N_PLUS_ONE:
+            print('!! N+1: %s %s ran %d times: %s' % (request.method, request.path, count, ' '.join(statement.split())))
+
+    if total * 1000 >= SLOW_REQUEST_MS:
+        lines = ['!! slow request: %s %s %d %.1fms' % (request.method, request.path, response.status_code, total * 1000)]
+        for name, start, duration, detail in sorted(trace, key=lambda span: span[1]):
+            line = '!!   +%.1fms %s %.1fms' % ((start - g.trace_start) * 1000, name, duration * 1000)
+            if detail:
+                line = line + ' ' + ' '.join(detail.split())
+            lines.append(line)
+        print('\n'.join(lines))
+
+    return response
+
+def trace_view(view):
+    """
+    Mark where the view returned, the response span runs from there to end_trace
+    """
+    @functools.wraps(view)
+    def traced(*args, **kwargs):
+        result = view(*args, **kwargs)
+        g.trace_view_end = time.time()
+        return result
+    return traced
+
+def enable_tracing():
+    """
+    Trace every request on both apps and every SQL statement. Call after all routes are registered.
+    """
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', handle_error)
+    for flask_app in (app, management):
+        flask_app.before_request(start_trace)
+        flask_app.after_request(end_trace)
+        for endpoint, view in list(flask_app.view_functions.items()):
+            flask_app.view_functions[endpoint] = trace_view(view)
+
+# one profile at a time
+profile_lock = threading.Lock()
+
+def sample_stacks(seconds, interval=0.01):
+    """
+    Sample the stacks of all other threads, returns them folded (flamegraph.pl format)
+    """
+    me = threading.current_thread().ident
+    counts = {}
+    end = time.time() + seconds
+    while time.time() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            folded = ';'.join(reversed(stack))
+            counts[folded] = counts.get(folded, 0) + 1
+        time.sleep(interval)
+    return '\n'.join('%s %d' % (folded, count) for folded, count in sorted(counts.items()))
+
+@management.route('/api/profile', methods=['GET'])
+@auth.login_required
+def get_profile():
+    try:
+        try:
+            seconds = float(request.args.get('seconds', 10))
+        except ValueError:
+            seconds = float('nan')
+        if math.isnan(seconds) or seconds <= 0 or seconds > 60:
+            return (to_json({'error': 'seconds must be between 0 and 60'}), 400)
+
+        if not profile_lock.acquire(False):
+            return (to_json({'error': 'a profile is already running'}), 409)
+        try:
+            return (sample_stacks(seconds), 200, {'Content-Type': 'text/plain'})
+        finally:
+            profile_lock.release()
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        print(''.join('!! ' + line for line in lines))  # Log it or whatever here
+        abort(503)
+
+@management.route('/api/queries', methods=['GET'])
+@auth.login_required
+def get_queries():
+    try:
+        with query_stats_lock:
+            results = [{'statement': statement, 'count': stats[0], 'seconds': stats[1]} for statement, stats in query_stats.items()]
+
+        results.sort(key=lambda result: result['count'], reverse=True)
+        return to_json({'tracing': TRACE, 'queries': results})
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        print(''.join('!! ' + line for line in lines))  # Log it or whatever here
+        abort(503)
+
+if TRACE:
+    enable_tracing()
+
 def app_thread():
     # run app on port 80
     app.run(host='0.0.0.0',port=80, debug=True, use_reloader=False)
 
 def management_thread():
-    # run mgmt on 8888
-    management.run(host='0.0.0.0',port=8888, debug=True, use_reloader=False)
+    # run mgmt on 8888, threaded so a running profile or snapshot doesn't block the other requests
+    management.run(host='0.0.0.0',port=8888, debug=True, use_reloader=False, threaded=True)
+
+def snapshot_thread():
+    # take a periodic snapshot
+    try:
+        snapshot_database()
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        print(''.join('!! ' + line for line in lines))  # Log it or whatever here
 
 if __name__ == '__main__':
     key = 'ThisIsMySuperSecretKey'
 
     app.config['SECRET_KEY'] = key
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////database/db.sqlite'
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
     app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 
     management.config['SECRET_KEY'] = key
-    management.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite'
+    management.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
     management.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
     management.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 
-    # in case the database doesn't exists: make it
-    if not os.path.exists('db.sqlite'):
-        db.create_all()
-
-    # start an app thread and a mgmt thread
-    appthread = threading.Timer(1, app_thread)
-    mgmtthread = threading.Timer(1, management_thread)
-
-    while True:
-        # keep a loop, if one of the threads gets killed: revive it
-        if not appthread.isAlive():
-            print('App thread dead, starting...')
+    # restore: python qndbmq.py restore [snapshot]
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        restore_database(sys.argv[2] if len(sys.argv) > 2 else None)
+        print('Database restored')
+        sys.exit(0)
 
-            appthread = threading.Timer(1, app_thread)
-            appthread.start()
+    # validate (or restore) the database, create missing tables and warm the cache
+    startup_database()
 
-        if not mgmtthread.isAlive():
-            print('Management thread dead, starting...')
+    # docker stop sends SIGTERM, exit through the finally below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-            mgmtthread = threading.Timer(1, management_thread)
-            mgmtthread.start()
+    # start an app thread, a mgmt thread and a snapshot thread
+    appthread = threading.Timer(1, app_thread)
+    mgmtthread = threading.Timer(1, management_thread)
+    snapthread = threading.Timer(SNAPSHOT_INTERVAL, snapshot_thread)
 
-        time.sleep(5)
+    try:
+        while True:
+            # keep a loop, if one of the threads gets killed: revive it
+            if not appthread.isAlive():
+                print('App thread dead, starting...')
+
+                appthread = threading.Timer(1, app_thread)
+                appthread.daemon = True
+                appthread.start()
+
+            if not mgmtthread.isAlive():
+                print('Management thread dead, starting...')
+
+                mgmtthread = threading.Timer(1, management_thread)
+                mgmtthread.daemon = True
+                mgmtthread.start()
+
+            if not snapthread.isAlive():
+                # a finished snapshot timer schedules the next one
+                snapthread = threading.Timer(SNAPSHOT_INTERVAL, snapshot_thread)
+                snapthread.daemon = True
+                snapthread.start()
+
+            time.sleep(5)
+    finally:
+        # clean stop, no full check needed on the next start
+        if os.path.exists(RUNNING_PATH):
+            os.remove(RUNNING_PATH)
 
 
 